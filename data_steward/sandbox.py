@@ -1,3 +1,6 @@
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+
 from bq_utils import create_dataset
 from constants import bq_utils as bq_consts
 from utils.bq import list_datasets
@@ -5,6 +8,9 @@ import re
 
 SANDBOX_SUFFIX = 'sandbox'
 
+# matches characters which are not permitted in table names
+_NON_WORD_RE = re.compile(r'\W')
+
 
 def create_sandbox_dataset(project_id, dataset_id):
     """
@@ -32,8 +38,7 @@ def get_sandbox_dataset_id(dataset_id):
     :param dataset_id: any dataset_id
     :return:
     """
-    return '{dataset_id}_{sandbox_suffix}'.format(dataset_id=dataset_id,
-                                                  sandbox_suffix=SANDBOX_SUFFIX)
+    return '%s_%s' % (dataset_id, SANDBOX_SUFFIX)
 
 
 def get_sandbox_table_name(dataset_id, rule_name):
@@ -44,9 +49,21 @@ def get_sandbox_table_name(dataset_id, rule_name):
     :param rule_name: the name of the cleaning rule
     :return: the concatenated table name
     """
-    return '{dataset_id}_{rule_name}'.format(dataset_id=dataset_id,
-                                             rule_name=re.sub(
-                                                 r'\W', '_', rule_name))
+    return '%s_%s' % (dataset_id, _NON_WORD_RE.sub('_', rule_name))
+
+
+@lru_cache(maxsize=32)
+def _get_project_datasets(project_id):
+    """
+    A helper function to get the ids of all datasets in a project
+
+    Results are cached to avoid repeating the API round-trip for every
+    cleaning rule applied to the same project.
+
+    :param project_id: the project_id to list datasets for
+    :return: frozenset of dataset_ids in the project
+    """
+    return frozenset(d.dataset_id for d in list_datasets(project_id))
 
 
 def check_and_create_sandbox_dataset(project_id, dataset_id):
@@ -58,9 +75,44 @@ def check_and_create_sandbox_dataset(project_id, dataset_id):
     :return: the sandbox dataset_name that either exists or was created
     """
     sandbox_dataset = get_sandbox_dataset_id(dataset_id)
-    dataset_objs = list_datasets(project_id)
-    datasets = [d.dataset_id for d in dataset_objs]
 
-    if sandbox_dataset not in datasets:
+    if sandbox_dataset not in _get_project_datasets(project_id):
         create_sandbox_dataset(project_id, dataset_id)
+        # the cached listing is stale now that a dataset was created
+        _get_project_datasets.cache_clear()
     return sandbox_dataset
+
+
+def check_and_create_sandbox_datasets(project_id, dataset_ids):
+    """
+    A helper function to check a batch of sandbox datasets and create any that are missing
+
+    The project's datasets are listed once for the whole batch rather
+    than once per dataset.
+
+    :param project_id: the project_id that the datasets are in
+    :param dataset_ids: the dataset_ids to verify
+    :return: the list of sandbox dataset names that exist or were created
+    """
+    existing_datasets = _get_project_datasets(project_id)
+    missing_dataset_ids = [
+        dataset_id for dataset_id in dataset_ids
+        if get_sandbox_dataset_id(dataset_id) not in existing_datasets
+    ]
+    if missing_dataset_ids:
+        try:
+            # the create calls are independent IO-bound API requests, so
+            # issue them in parallel
+            with ThreadPoolExecutor() as executor:
+                futures = [
+                    executor.submit(create_sandbox_dataset, project_id,
+                                    dataset_id)
+                    for dataset_id in missing_dataset_ids
+                ]
+                for future in futures:
+                    future.result()
+        finally:
+            # even on partial failure some datasets may have been
+            # created, so the cached listing is stale either way
+            _get_project_datasets.cache_clear()
+    return [get_sandbox_dataset_id(dataset_id) for dataset_id in dataset_ids]
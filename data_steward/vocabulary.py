@@ -5,62 +5,202 @@ be reformatted and records for the AOU Generalization and AOU Custom vocabularie
 """
 import csv
 import logging
+import mmap
 import os
+import queue
+import shutil
 import sys
+import threading
 import warnings
 import re
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+
+import pandas as pd
+from google.cloud import bigquery
 
 from common import (CONCEPT, VOCABULARY, DELIMITER, LINE_TERMINATOR,
                     TRANSFORM_FILES, APPEND_VOCABULARY, APPEND_CONCEPTS,
                     ADD_AOU_VOCABS, ERRORS, ERROR_APPENDING, VOCABULARY_UPDATES,
                     AOU_GEN_ID, AOU_CUSTOM_ID)
 from resources import AOU_VOCAB_PATH, AOU_VOCAB_CONCEPT_CSV_PATH, hash_dir
-from io import open
+from utils import bq
+from io import open, StringIO
 
 RAW_DATE_PATTERN = re.compile(r'\d{8}$')
 BQ_DATE_PATTERN = re.compile(r'\d{4}-\d{2}-\d{2}$')
 
+# number of bytes of input to read at a time while transforming csv files
+TRANSFORM_CHUNK_BYTES = 16 << 20
+
+# number of transformed chunks that may wait to be written before the
+# parse stage blocks; bounds memory use while transforming csv files
+TRANSFORM_QUEUE_SIZE = 2
+
+# AOU vocabulary IDs, longest first so an ID which contains another as
+# a prefix is always the one reported by the alternation below
+AOU_VOCAB_IDS = tuple(sorted(VOCABULARY_UPDATES, key=len, reverse=True))
+
+# matches any AOU vocabulary ID in a single pass over the input
+VOCAB_ID_PATTERN = re.compile('|'.join(
+    re.escape(vocab_id) for vocab_id in AOU_VOCAB_IDS))
+
+# bytes version of the above for scanning memory-mapped files
+VOCAB_ID_BYTES_PATTERN = re.compile(VOCAB_ID_PATTERN.pattern.encode())
+
+# number of rows to buffer between writes while copying vocabulary files
+COPY_BUFFER_ROWS = 10000
+
+# buffer size in bytes used when opening vocabulary files
+FILE_BUFFER_SIZE = 1 << 20
+
 csv.field_size_limit(sys.maxsize)
 
 
+@lru_cache(maxsize=65536)
 def format_date_str(date_str):
     """
     Format a date string to yyyymmdd if it is not already
+
+    Vocabulary files contain few distinct dates relative to their row
+    counts, so results are memoized.
+
     :param date_str: the date string
     :return: the formatted date string
     :raises:  ValueError if a valid date object cannot be parsed from the string
     """
-    if BQ_DATE_PATTERN.match(date_str):
-        formatted_date_str = date_str
-    elif RAW_DATE_PATTERN.match(date_str):
-        parts = date_str[0:4], date_str[4:6], date_str[6:8]
-        formatted_date_str = '-'.join(parts)
-    else:
-        raise ValueError('Cannot parse value {v} as date'.format(v=date_str))
-    return formatted_date_str
+    # both accepted formats are fixed-length, so the length check and
+    # direct slicing avoid the regex engine on the fast path
+    n = len(date_str)
+    if (n == 10 and date_str[4] == '-' and date_str[7] == '-' and
+            date_str.replace('-', '').isdigit()):
+        return date_str
+    if n == 8 and date_str.isdigit():
+        return date_str[0:4] + '-' + date_str[4:6] + '-' + date_str[6:8]
+    raise ValueError('Cannot parse value {v} as date'.format(v=date_str))
+
+
+def _transform_rows(rows, date_indexes, err_fp):
+    """
+    Format date fields of rows one at a time, reporting rows that fail
+
+    :param rows: iterable of rows (lists of field values)
+    :param date_indexes: indexes of the date fields in each row
+    :param err_fp: file-like object where failing rows are reported
+    :return: list of successfully transformed rows
+    """
+    transformed_rows = []
+    error_messages = []
+    for row in rows:
+        try:
+            for i in date_indexes:
+                row[i] = format_date_str(row[i])
+            transformed_rows.append(row)
+        except (ValueError, IndexError) as e:
+            error_messages.append((str(e), row))
+    # write failures in one call rather than one write per row
+    err_fp.writelines('Error %s transforming row:\n%s' % (error, row)
+                      for error, row in error_messages)
+    return transformed_rows
 
 
 def _transform_csv(in_fp, out_fp, err_fp=None):
     if not err_fp:
         err_fp = sys.stderr
-    csv_reader = csv.reader(in_fp, delimiter=DELIMITER)
-    header = next(csv_reader)
+    header = in_fp.readline().rstrip('\r\n').split(DELIMITER)
     date_indexes = []
     for index, item in enumerate(header):
         if item.endswith('_date'):
             date_indexes.append(index)
-    csv_writer = csv.writer(out_fp,
-                            delimiter=DELIMITER,
-                            lineterminator=LINE_TERMINATOR)
-    csv_writer.writerow(header)
-    for row in csv_reader:
+    out_fp.write(DELIMITER.join(header) + LINE_TERMINATOR)
+
+    # write transformed chunks on a separate thread so file output
+    # overlaps with parsing and transforming the next chunk
+    chunk_queue = queue.Queue(maxsize=TRANSFORM_QUEUE_SIZE)
+    write_errors = []
+
+    def _write_chunks():
+        while True:
+            transformed_chunk = chunk_queue.get()
+            if transformed_chunk is None:
+                break
+            try:
+                transformed_chunk.to_csv(out_fp,
+                                         sep=DELIMITER,
+                                         header=False,
+                                         index=False)
+            except Exception as e:
+                write_errors.append(e)
+
+    writer = threading.Thread(target=_write_chunks)
+    writer.start()
+    # rows the tokenizer rejects (e.g. extra fields) are reported one
+    # ParserWarning per row; capture them for the error file instead of
+    # letting a malformed line abort the whole transform
+    with warnings.catch_warnings(record=True) as parse_warnings:
+        warnings.simplefilter('always', pd.errors.ParserWarning)
         try:
-            for i in date_indexes:
-                row[i] = format_date_str(row[i])
-            csv_writer.writerow(row)
-        except (ValueError, IndexError) as e:
-            message = 'Error %s transforming row:\n%s' % (str(e), row)
-            err_fp.write(message)
+            while True:
+                lines = in_fp.readlines(TRANSFORM_CHUNK_BYTES)
+                if not lines:
+                    break
+                # rows with fewer fields than the header would be padded
+                # by the parser, silently adding delimiters the input
+                # never had; quarantine them before parsing instead
+                delimiter_counts = pd.Series(lines).str.count(DELIMITER)
+                short = delimiter_counts < len(header) - 1
+                if short.any():
+                    err_fp.writelines(
+                        'Error expected %d fields transforming row:\n%s' %
+                        (len(header), line)
+                        for line, is_short in zip(lines, short) if is_short)
+                    lines = [
+                        line for line, is_short in zip(lines, short)
+                        if not is_short
+                    ]
+                try:
+                    chunk = pd.read_csv(StringIO(''.join(lines)),
+                                        sep=DELIMITER,
+                                        header=None,
+                                        names=header,
+                                        dtype=str,
+                                        keep_default_na=False,
+                                        na_filter=False,
+                                        engine='c',
+                                        index_col=False,
+                                        on_bad_lines='warn')
+                except pd.errors.EmptyDataError:
+                    # nothing parseable was left in this chunk
+                    continue
+                chunk = chunk.fillna('')
+                valid = pd.Series(True, index=chunk.index)
+                for i in date_indexes:
+                    col = chunk.columns[i]
+                    dates = chunk[col]
+                    raw = dates.str.match(RAW_DATE_PATTERN)
+                    bq_formatted = dates.str.match(BQ_DATE_PATTERN)
+                    chunk.loc[raw, col] = (dates.str.slice(0, 4) + '-' +
+                                           dates.str.slice(4, 6) + '-' +
+                                           dates.str.slice(6, 8))[raw]
+                    valid &= raw | bq_formatted
+                chunk_queue.put(chunk[valid])
+                if not valid.all():
+                    # report rows with malformed dates individually
+                    bad_rows = [
+                        list(row)
+                        for row in chunk[~valid].itertuples(index=False,
+                                                            name=None)
+                    ]
+                    _transform_rows(bad_rows, date_indexes, err_fp)
+        finally:
+            chunk_queue.put(None)
+            writer.join()
+    err_fp.writelines(
+        'Error transforming row: %s\n' % str(warning.message).strip()
+        for warning in parse_warnings
+        if issubclass(warning.category, pd.errors.ParserWarning))
+    if write_errors:
+        raise write_errors[0]
 
 
 def transform_file(file_path, out_dir):
@@ -80,10 +220,9 @@ def transform_file(file_path, out_dir):
     except OSError:
         logging.info(f"Error directory:\t{err_dir}\t already exists")
 
-    with open(file_path,
-              'r') as in_fp, open(out_file_name,
-                                  'w') as out_fp, open(err_file_name,
-                                                       'w') as err_fp:
+    with open(file_path, 'r', buffering=FILE_BUFFER_SIZE) as in_fp, \
+            open(out_file_name, 'w', buffering=FILE_BUFFER_SIZE) as out_fp, \
+            open(err_file_name, 'w') as err_fp:
         _transform_csv(in_fp, out_fp, err_fp)
 
 
@@ -94,16 +233,108 @@ def transform_files(in_dir, out_dir):
     :param in_dir: Directory containing vocabulary csv files
     :param out_dir: Directory to save the transformed file
     """
-    fs = os.listdir(in_dir)
-    for f in fs:
-        in_path = os.path.join(in_dir, f)
-        transform_file(in_path, out_dir)
+    with os.scandir(in_dir) as entries:
+        in_paths = [entry.path for entry in entries if entry.is_file()]
+    # the files are independent of one another, so transform them in
+    # parallel across processes
+    with ProcessPoolExecutor() as executor:
+        futures = [
+            executor.submit(transform_file, in_path, out_dir)
+            for in_path in in_paths
+        ]
+        for future in futures:
+            future.result()
+
+
+class _PipeReader:
+    """
+    Minimal binary stream adapter over a pipe for upload clients
+
+    Pipes do not support tell(), which resumable uploads use to track
+    progress, so the number of bytes read is tracked here instead.
+    """
+
+    def __init__(self, raw):
+        self._raw = raw
+        self._pos = 0
+
+    def read(self, size=-1):
+        data = self._raw.read(size)
+        self._pos += len(data)
+        return data
+
+    def tell(self):
+        return self._pos
+
+
+def transform_and_load_file(file_path, project_id, dataset_id):
+    """
+    Transform a vocabulary file and load it into a BigQuery table
 
+    The transformed rows are streamed to the load job through a pipe,
+    so the output is never written to local disk.
 
+    :param file_path: Path to the csv file
+    :param project_id: Identifies the project to load the table in
+    :param dataset_id: Identifies the dataset to load the table in
+    :return: the completed LoadJob
+    """
+    file_name = os.path.basename(file_path)
+    table_name, _ = os.path.splitext(file_name.lower())
+    client = bq.get_client(project_id)
+    job_config = bigquery.LoadJobConfig(
+        schema=bq.get_table_schema(table_name),
+        skip_leading_rows=1,
+        field_delimiter=DELIMITER,
+        quote_character='',
+        source_format=bigquery.SourceFormat.CSV)
+
+    read_fd, write_fd = os.pipe()
+    read_fp = os.fdopen(read_fd, 'rb')
+    write_fp = os.fdopen(write_fd, 'w', buffering=FILE_BUFFER_SIZE)
+    transform_errors = []
+
+    def _produce():
+        try:
+            with open(file_path, 'r', buffering=FILE_BUFFER_SIZE) as in_fp:
+                _transform_csv(in_fp, write_fp)
+        except Exception as e:
+            transform_errors.append(e)
+        finally:
+            # signals end of input to the load job; the read end may
+            # already be closed if the load failed
+            try:
+                write_fp.close()
+            except OSError:
+                pass
+
+    producer = threading.Thread(target=_produce)
+    producer.start()
+    try:
+        job = client.load_table_from_file(
+            _PipeReader(read_fp),
+            '%s.%s.%s' % (project_id, dataset_id, table_name),
+            job_config=job_config)
+        job.result()
+    finally:
+        # close the read end before joining: if the load failed while
+        # the producer was blocked writing into the full pipe, this
+        # raises BrokenPipeError in the producer so the join cannot hang
+        read_fp.close()
+        producer.join()
+    if transform_errors:
+        raise transform_errors[0]
+    return job
+
+
+@lru_cache(maxsize=1)
 def get_aou_vocab_version():
     """
     Generate an identifier used to version AOU vocabulary resources
 
+    The resource files do not change within a run, so the digest is
+    computed once and cached.
+
     :return: unique identifier string
     """
     return hash_dir(AOU_VOCAB_PATH)
@@ -118,7 +349,8 @@ def get_aou_vocabulary_row(vocab_id):
     """
     aou_vocab_version = get_aou_vocab_version()
     # vocabulary_id vocabulary_name vocabulary_reference vocabulary_version vocabulary_concept_id
-    vocab_row = VOCABULARY_UPDATES.get(vocab_id)
+    # copy the row so the shared module-level value is not mutated
+    vocab_row = list(VOCABULARY_UPDATES[vocab_id])
     vocab_row[-2] = aou_vocab_version
     return DELIMITER.join(vocab_row)
 
@@ -130,10 +362,82 @@ def _vocab_id_match(s):
     :param s: string to search for AOU vocabulary IDs
     :return: the first vocabulary ID found in the string, otherwise None
     """
-    vocab_id_in_row_iter = (
-        vocab_id for vocab_id in VOCABULARY_UPDATES if vocab_id in s)
-    # if there are matches return the first one, otherwise None
-    return next(vocab_id_in_row_iter, None)
+    # a single scan of the string finds any of the IDs
+    match = VOCAB_ID_PATTERN.search(s)
+    return match.group(0) if match else None
+
+
+def _has_header(first_line):
+    """
+    Determine if the first line of a concept csv file is a header row
+
+    Concept rows always begin with a numeric concept_id, so a
+    non-numeric first field identifies a header.
+
+    :param first_line: the first line of the file
+    :return: True if the line is a header row, False otherwise
+    """
+    first_field = first_line.split(DELIMITER, 1)[0]
+    return not first_field.isdigit()
+
+
+def _copy_aou_free_rows(in_fp, out_fp, in_path):
+    """
+    Copy rows which do not refer to AOU vocabularies to the specified file
+
+    Rows are buffered and written in bulk rather than one at a time.
+    A warning is raised for any row which refers to an AOU vocabulary.
+
+    :param in_fp: file-like object to copy rows from
+    :param out_fp: file-like object to copy rows to
+    :param in_path: path of the input file, used in warning messages
+    """
+    buffered_rows = []
+    for row in in_fp:
+        # check if the vocab_id is in the row text
+        vocab_id_in_row = _vocab_id_match(row)
+        if vocab_id_in_row:
+            # skip it so it is appended below
+            warnings.warn(
+                ERROR_APPENDING.format(in_path=in_path,
+                                       vocab_id=vocab_id_in_row))
+        else:
+            buffered_rows.append(row)
+            if len(buffered_rows) >= COPY_BUFFER_ROWS:
+                out_fp.writelines(buffered_rows)
+                buffered_rows.clear()
+    out_fp.writelines(buffered_rows)
+
+
+def _contains_aou_vocab(in_path):
+    """
+    Determine if any AOU vocabulary ID appears in the specified file
+
+    The file is memory-mapped and scanned with a single multi-pattern
+    search, so no per-line work is done.
+
+    :param in_path: path of the file to scan
+    :return: True if an AOU vocabulary ID appears in the file
+    """
+    with open(in_path, 'rb') as fp:
+        try:
+            mm = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # an empty file cannot be mapped (and contains no IDs)
+            return False
+        with mm:
+            return VOCAB_ID_BYTES_PATTERN.search(mm) is not None
+
+
+def _copy_file(in_path, out_path):
+    """
+    Copy a file in bulk without inspecting its contents
+
+    :param in_path: path of the file to copy
+    :param out_path: location to save the copy
+    """
+    with open(in_path, 'rb') as in_fp, open(out_path, 'wb') as out_fp:
+        shutil.copyfileobj(in_fp, out_fp, length=FILE_BUFFER_SIZE)
 
 
 def append_concepts(in_path, out_path):
@@ -143,35 +447,33 @@ def append_concepts(in_path, out_path):
     :param in_path: existing concept file
     :param out_path: location to save the updated concept file
     """
-    with open(out_path, 'w') as out_fp:
-        # copy original rows line by line for memory efficiency
-        with open(in_path, 'r') as in_fp:
-            for row in in_fp:
-                # check if the vocab_id is in the row text
-                vocab_id_in_row = _vocab_id_match(row)
-                if vocab_id_in_row:
-                    # skip it so it is appended below
-                    warnings.warn(
-                        ERROR_APPENDING.format(in_path=in_path,
-                                               vocab_id=vocab_id_in_row))
-                else:
-                    out_fp.write(row)
-
-        # append new rows
-        with open(AOU_VOCAB_CONCEPT_CSV_PATH, 'r') as aou_gen_fp:
-            # Sending the first five lines of the file because tab delimiters
-            # are causing trouble with the Sniffer and has_header method
-            five_lines = ''
-            for _ in range(0, 5):
-                five_lines += aou_gen_fp.readline()
-
-            has_header = csv.Sniffer().has_header(five_lines)
-            aou_gen_fp.seek(0)
-            # skip header if present
-            if has_header:
-                next(aou_gen_fp)
-            for row in aou_gen_fp:
-                out_fp.write(row)
+    if _contains_aou_vocab(in_path):
+        # copy original rows in bulk, filtering out AOU rows so they
+        # are appended below
+        with open(out_path, 'w', buffering=FILE_BUFFER_SIZE) as out_fp:
+            with open(in_path, 'r', buffering=FILE_BUFFER_SIZE) as in_fp:
+                _copy_aou_free_rows(in_fp, out_fp, in_path)
+            _append_aou_concepts(out_fp)
+    else:
+        # common case: no rows need filtering, so copy the file
+        # wholesale and append to it
+        _copy_file(in_path, out_path)
+        with open(out_path, 'a', buffering=FILE_BUFFER_SIZE) as out_fp:
+            _append_aou_concepts(out_fp)
+
+
+def _append_aou_concepts(out_fp):
+    """
+    Append the AOU concept rows to the specified file
+
+    :param out_fp: file-like object to append rows to
+    """
+    # append new rows, skipping the header if present
+    with open(AOU_VOCAB_CONCEPT_CSV_PATH, 'r') as aou_gen_fp:
+        first_line = aou_gen_fp.readline()
+        if not _has_header(first_line):
+            out_fp.write(first_line)
+        out_fp.writelines(aou_gen_fp)
 
 
 def append_vocabulary(in_path, out_path):
@@ -182,24 +484,32 @@ def append_vocabulary(in_path, out_path):
     :param out_path: location to save the updated vocabulary file
     :return:
     """
+    if _contains_aou_vocab(in_path):
+        # copy original rows in bulk, filtering out AOU rows so they
+        # are appended below
+        with open(out_path, 'w', buffering=FILE_BUFFER_SIZE) as out_fp:
+            with open(in_path, 'r', buffering=FILE_BUFFER_SIZE) as in_fp:
+                _copy_aou_free_rows(in_fp, out_fp, in_path)
+            _append_aou_vocabulary_rows(out_fp)
+    else:
+        # common case: no rows need filtering, so copy the file
+        # wholesale and append to it
+        _copy_file(in_path, out_path)
+        with open(out_path, 'a', buffering=FILE_BUFFER_SIZE) as out_fp:
+            _append_aou_vocabulary_rows(out_fp)
+
+
+def _append_aou_vocabulary_rows(out_fp):
+    """
+    Append the AoU_General and AoU_Custom rows to the specified file
+
+    :param out_fp: file-like object to append rows to
+    """
     aou_general_row = get_aou_vocabulary_row(AOU_GEN_ID)
     aou_custom_row = get_aou_vocabulary_row(AOU_CUSTOM_ID)
-    with open(out_path, 'w') as out_fp:
-        # copy original rows line by line for memory efficiency
-        with open(in_path, 'r') as in_fp:
-            for row in in_fp:
-                vocab_id_in_row = _vocab_id_match(row)
-                if vocab_id_in_row:
-                    # skip it so it is appended below
-                    warnings.warn(
-                        ERROR_APPENDING.format(in_path=in_path,
-                                               vocab_id=vocab_id_in_row))
-                else:
-                    out_fp.write(row)
-        # append AoU_General and AoU_Custom
-        # newline needed here because write[lines] does not include line separator
-        out_fp.write(aou_general_row + '\n')
-        out_fp.write(aou_custom_row)
+    # newline needed here because write[lines] does not include line separator
+    out_fp.write(aou_general_row + '\n')
+    out_fp.write(aou_custom_row)
 
 
 def add_aou_vocabs(in_dir, out_dir):
@@ -210,25 +520,23 @@ def add_aou_vocabs(in_dir, out_dir):
     :param out_dir: location to save the updated vocabulary files
     :return:
     """
-    file_names = os.listdir(in_dir)
-    concept_in_path = None
-    vocabulary_in_path = None
+    required_paths = {CONCEPT: None, VOCABULARY: None}
     # Case-insensitive search for concept and vocabulary files
-    for file_name in file_names:
-        table_name, _ = os.path.splitext(file_name.lower())
-        in_path = os.path.join(in_dir, file_name)
-        if table_name == CONCEPT:
-            concept_in_path = in_path
-        elif table_name == VOCABULARY:
-            vocabulary_in_path = in_path
-    if concept_in_path is None:
-        raise IOError('CONCEPT.csv was not found in %s' % in_dir)
-    if vocabulary_in_path is None:
-        raise IOError('VOCABULARY.csv was not found in %s' % in_dir)
-
+    with os.scandir(in_dir) as entries:
+        for entry in entries:
+            table_name, _ = os.path.splitext(entry.name.lower())
+            if table_name in required_paths:
+                required_paths[table_name] = entry.path
+    for table_name, in_path in required_paths.items():
+        if in_path is None:
+            raise IOError('%s.csv was not found in %s' %
+                          (table_name.upper(), in_dir))
+
+    concept_in_path = required_paths[CONCEPT]
     concept_out_path = os.path.join(out_dir, os.path.basename(concept_in_path))
     append_concepts(concept_in_path, concept_out_path)
 
+    vocabulary_in_path = required_paths[VOCABULARY]
     vocabulary_out_path = os.path.join(out_dir,
                                        os.path.basename(vocabulary_in_path))
     append_vocabulary(vocabulary_in_path, vocabulary_out_path)
@@ -1,4 +1,7 @@
 import unittest
+
+import mock
+
 import sandbox
 
 
@@ -11,7 +14,10 @@ class SandboxTest(unittest.TestCase):
         print('**************************************************************')
 
     def setUp(self):
+        self.project_id = 'test_project'
         self.dataset_id = 'test_dataset'
+        # each test should see a fresh dataset listing
+        sandbox._get_project_datasets.cache_clear()
 
     def test_get_sandbox_table_name(self):
         rule_name = 'abc_123'
@@ -25,3 +31,41 @@ class SandboxTest(unittest.TestCase):
         self.assertEqual(expected, actual)
         actual = sandbox.get_sandbox_table_name(self.dataset_id, 'abc~123')
         self.assertEqual(expected, actual)
+
+    @mock.patch('sandbox.create_sandbox_dataset')
+    @mock.patch('sandbox.list_datasets')
+    def test_check_and_create_sandbox_datasets(self, mock_list_datasets,
+                                               mock_create):
+        existing = mock.Mock()
+        existing.dataset_id = sandbox.get_sandbox_dataset_id('dataset_1')
+        mock_list_datasets.return_value = [existing]
+
+        expected = [
+            sandbox.get_sandbox_dataset_id('dataset_1'),
+            sandbox.get_sandbox_dataset_id('dataset_2')
+        ]
+        actual = sandbox.check_and_create_sandbox_datasets(
+            self.project_id, ['dataset_1', 'dataset_2'])
+        self.assertEqual(expected, actual)
+        # only the missing dataset is created and the listing happens once
+        mock_create.assert_called_once_with(self.project_id, 'dataset_2')
+        mock_list_datasets.assert_called_once_with(self.project_id)
+
+    @mock.patch('sandbox.create_sandbox_dataset')
+    @mock.patch('sandbox.list_datasets')
+    def test_check_and_create_sandbox_datasets_partial_failure(
+            self, mock_list_datasets, mock_create):
+        mock_list_datasets.return_value = []
+
+        def create(project_id, dataset_id):
+            if dataset_id == 'dataset_2':
+                raise RuntimeError('create failed')
+
+        mock_create.side_effect = create
+        with self.assertRaises(RuntimeError):
+            sandbox.check_and_create_sandbox_datasets(
+                self.project_id, ['dataset_1', 'dataset_2'])
+        # the cached listing must be invalidated on partial failure so a
+        # retry sees the datasets which were created before the error
+        sandbox._get_project_datasets(self.project_id)
+        self.assertEqual(mock_list_datasets.call_count, 2)
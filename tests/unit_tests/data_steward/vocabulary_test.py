@@ -14,7 +14,7 @@ from resources import AOU_VOCAB_CONCEPT_CSV_PATH
 from tests.test_util import TEST_VOCABULARY_VOCABULARY_CSV, TEST_VOCABULARY_CONCEPT_CSV
 from vocabulary import (_transform_csv, format_date_str, get_aou_vocabulary_row,
                         append_vocabulary, append_concepts, AOU_GEN_ID,
-                        AOU_CUSTOM_ID, _vocab_id_match)
+                        AOU_CUSTOM_ID, _vocab_id_match, transform_and_load_file)
 
 
 class VocabularyTest(unittest.TestCase):
@@ -77,6 +77,33 @@ class VocabularyTest(unittest.TestCase):
         s3 = 'dummy,text,' + AOU_CUSTOM_ID + ',dummy,text'
         self.assertEqual(_vocab_id_match(s3), AOU_CUSTOM_ID)
 
+    @mock.patch('vocabulary.bq')
+    def test_transform_and_load_file_error(self, mock_bq):
+
+        # simulates a client which fails after partially consuming the stream
+        def fail_mid_read(file_obj, destination, job_config=None):
+            file_obj.read(1024)
+            raise RuntimeError('load failed')
+
+        mock_bq.get_table_schema.return_value = []
+        mock_client = mock_bq.get_client.return_value
+        mock_client.load_table_from_file.side_effect = fail_mid_read
+
+        in_dir = tempfile.mkdtemp()
+        in_path = os.path.join(in_dir, 'CONCEPT.CSV')
+        try:
+            # large enough that the transform is still blocked writing
+            # into the full pipe when the load fails
+            with open(in_path, 'w') as in_fp:
+                in_fp.write('concept_id\tvalid_start_date\n')
+                for i in range(200000):
+                    in_fp.write('%d\t20190123\n' % i)
+            # the failure must propagate rather than hang the join
+            with self.assertRaises(RuntimeError):
+                transform_and_load_file(in_path, 'project_id', 'dataset_id')
+        finally:
+            shutil.rmtree(in_dir)
+
     def test_append_vocabulary(self):
         in_path = TEST_VOCABULARY_VOCABULARY_CSV
         out_dir = tempfile.mkdtemp()